@@ -0,0 +1,105 @@
+import threading
+import numpy as np
+
+from scipy import fft, ndimage
+
+
+MAX_DIRECT_KERNEL_SIZE = 49
+MAX_CACHED_BUFFERS = 16
+
+_local = threading.local()
+
+
+def convolve(images, kernels, workers=1):
+    images = np.asarray(images)
+    kernels = np.asarray(kernels)
+    dtype = np.result_type(images.dtype, np.float32)
+    shape = images.shape
+
+    if kernels.ndim == 3:
+        batch = images if images.ndim == 4 else images[..., np.newaxis]
+    elif images.ndim == 4:
+        batch = images
+    else:
+        batch = (images if images.ndim == 3 else images[..., np.newaxis])[np.newaxis]
+
+    kernels = kernels.reshape((-1,) + kernels.shape[-2:])
+
+    if kernels.shape[1] > batch.shape[1] or kernels.shape[2] > batch.shape[2]:
+        result = _convolve_direct(batch, kernels, dtype)
+    elif kernels.shape[1] * kernels.shape[2] <= MAX_DIRECT_KERNEL_SIZE:
+        result = _convolve_direct(batch, kernels, dtype)
+    elif len(kernels) == 1 and _separable(kernels[0]) is not None:
+        result = _convolve_separable(batch, _separable(kernels[0]), dtype)
+    else:
+        result = _convolve_fft(batch, kernels, dtype, workers)
+
+    return result.reshape(shape)
+
+
+def _convolve_direct(images, kernels, dtype):
+    result = np.empty(images.shape, dtype=dtype)
+
+    for i in range(len(images)):
+        kernel = kernels[i % len(kernels)]
+
+        for j in range(images.shape[3]):
+            result[i, :, :, j] = ndimage.convolve(images[i, :, :, j].astype(dtype, copy=False), kernel)
+
+    return result
+
+
+def _separable(kernel):
+    u, s, vt = np.linalg.svd(kernel)
+
+    if len(s) > 1 and s[1] > 1e-7 * s[0]:
+        return None
+
+    return u[:, 0] * s[0], vt[0]
+
+
+def _convolve_separable(images, factors, dtype):
+    column, row = factors
+    result = ndimage.convolve1d(images.astype(dtype, copy=False), column, axis=1)
+
+    return ndimage.convolve1d(result, row, axis=2, output=result)
+
+
+def _convolve_fft(images, kernels, dtype, workers):
+    n, h, w, c = images.shape
+    kh, kw = kernels.shape[1:]
+    top, left = (kh - 1) // 2, (kw - 1) // 2
+    bottom, right = kh - 1 - top, kw - 1 - left
+    size = (fft.next_fast_len(h + kh - 1, real=True), fft.next_fast_len(w + kw - 1, real=True))
+
+    padded = _buffer((n, size[0], size[1], c), dtype)
+    padded[:, top:(top + h), left:(left + w)] = images
+    padded[:, :top, left:(left + w)] = images[:, top - 1::-1] if top > 0 else images[:, :0]
+    padded[:, (top + h):(top + h + bottom), left:(left + w)] = images[:, h - 1:h - 1 - bottom:-1]
+    padded[:, :(top + h + bottom), :left] = padded[:, :(top + h + bottom), 2 * left - 1:left - 1:-1] \
+        if left > 0 else padded[:, :(top + h + bottom), :0]
+    padded[:, :(top + h + bottom), (left + w):(left + w + right)] = \
+        padded[:, :(top + h + bottom), left + w - 1:left + w - 1 - right:-1]
+
+    spectrum = fft.rfft2(padded, axes=(1, 2), workers=workers)
+    spectrum *= fft.rfft2(kernels.astype(dtype, copy=False), s=size, axes=(1, 2), workers=workers)[..., np.newaxis]
+    result = fft.irfft2(spectrum, s=size, axes=(1, 2), workers=workers)
+
+    return np.ascontiguousarray(result[:, (kh - 1):(kh - 1 + h), (kw - 1):(kw - 1 + w)], dtype=dtype)
+
+
+def _buffer(shape, dtype):
+    buffers = getattr(_local, 'buffers', None)
+
+    if buffers is None:
+        buffers = _local.buffers = {}
+
+    key = (shape, np.dtype(dtype).str)
+
+    if key not in buffers:
+        if len(buffers) >= MAX_CACHED_BUFFERS:
+            buffers.clear()
+
+        buffers[key] = np.zeros(shape, dtype=dtype)
+
+    return buffers[key]
@@ -0,0 +1,89 @@
+import os
+import fcntl
+import hashlib
+import threading
+import numpy as np
+
+
+class ImageCache:
+    def __init__(self, path, shard_size=2 ** 30):
+        self.path = path
+        self.shard_size = shard_size
+        self.index_path = os.path.join(path, 'index.txt')
+        self.entries = {}
+        self.shards = {}
+        self.lock = threading.Lock()
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    fields = line.split()
+
+                    if len(fields) != 4:
+                        continue
+
+                    key, shard, offset, shape = fields
+                    self.entries[key] = (int(shard), int(offset), tuple(int(d) for d in shape.split('x')))
+
+        self.shard = max([entry[0] for entry in self.entries.values()] + [0])
+
+    @staticmethod
+    def key(path, shape=None, grayscale=False, normalize=True, draft=False):
+        fields = (os.path.abspath(path), os.path.getmtime(path), shape, grayscale, normalize, draft)
+
+        return hashlib.md5(str(fields).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+
+        if entry is None:
+            return None
+
+        shard, offset, shape = entry
+        size = int(np.prod(shape))
+        data = self.shards.get(shard)
+
+        if data is None or len(data) < offset + size:
+            data = np.memmap(self._shard_path(shard), dtype=np.uint8, mode='r')
+            self.shards[shard] = data
+
+        return data[offset:(offset + size)].reshape(shape)
+
+    def put(self, key, image):
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+
+        with self.lock:
+            if key in self.entries:
+                return
+
+            with open(self.index_path, 'a') as index:
+                fcntl.flock(index, fcntl.LOCK_EX)
+
+                try:
+                    while os.path.exists(self._shard_path(self.shard + 1)):
+                        self.shard += 1
+
+                    f = open(self._shard_path(self.shard), 'ab')
+
+                    if f.tell() > 0 and f.tell() + image.nbytes > self.shard_size:
+                        f.close()
+
+                        self.shard += 1
+                        f = open(self._shard_path(self.shard), 'ab')
+
+                    with f:
+                        offset = f.tell()
+                        f.write(image.tobytes())
+
+                    index.write('%s %d %d %s\n' % (key, self.shard, offset, 'x'.join(str(d) for d in image.shape)))
+                    index.flush()
+                finally:
+                    fcntl.flock(index, fcntl.LOCK_UN)
+
+            self.entries[key] = (self.shard, offset, image.shape)
+
+    def _shard_path(self, shard):
+        return os.path.join(self.path, 'shard_%05d.bin' % shard)
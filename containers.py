@@ -1,13 +1,19 @@
+import collections
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
 
+from multiprocessing.pool import ThreadPool
 from scipy import misc
+from noise import DEFAULT_DTYPE
+from decode import decode
+from resize import resize, resize_batch
 
 
 class Image:
     def __init__(self, image=None, path=None, shape=None, keep_in_memory=True, preload=False, normalize=True,
                  noise=None, grayscale=False, patch_size=None, sample_size=None, coordinates=None,
-                 noise_before_resize=True):
+                 noise_before_resize=True, cache=None, crop_first=False, dtype=DEFAULT_DTYPE, draft=False):
         if preload and not keep_in_memory:
             raise ValueError('Can\'t preload without keeping in memory')
 
@@ -26,6 +32,10 @@ class Image:
         self.sample_size = sample_size
         self.coordinates = coordinates
         self.noise_before_resize = noise_before_resize
+        self.cache = cache
+        self.crop_first = crop_first
+        self.dtype = dtype
+        self.draft = draft
         self.image = None
 
         if preload or image is not None:
@@ -40,7 +50,8 @@ class Image:
     def patch(self, size=None, coordinates=None, return_coordinates=False):
         image = Image(image=self.image, path=self.path, shape=self.shape, keep_in_memory=True, normalize=self.normalize,
                       noise=self.noise, grayscale=self.grayscale, patch_size=size, sample_size=self.sample_size,
-                      coordinates=coordinates, noise_before_resize=self.noise_before_resize)
+                      coordinates=coordinates, noise_before_resize=self.noise_before_resize, cache=self.cache,
+                      crop_first=self.crop_first, dtype=self.dtype, draft=self.draft)
         patch = image.get()
 
         if return_coordinates:
@@ -51,7 +62,8 @@ class Image:
     def sample(self, size=None, coordinates=None, return_coordinates=False):
         image = Image(image=self.image, path=self.path, shape=self.shape, keep_in_memory=True, normalize=self.normalize,
                       noise=self.noise, grayscale=self.grayscale, patch_size=self.patch_size, sample_size=size,
-                      coordinates=coordinates, noise_before_resize=self.noise_before_resize)
+                      coordinates=coordinates, noise_before_resize=self.noise_before_resize, cache=self.cache,
+                      crop_first=self.crop_first, dtype=self.dtype, draft=self.draft)
         sample = image.get()
 
         if return_coordinates:
@@ -60,25 +72,85 @@ class Image:
             return sample
 
     def load_and_process(self, image=None):
+        resized = False
+        crop_first = self.crop_first and (self.patch_size is None) != (self.sample_size is None) and \
+            (self.noise is None or not self.noise_before_resize or self.noise.pixelwise)
+
         if image is None:
-            image = misc.imread(self.path, mode='RGB')
-        else:
+            image, resized = self._decode()
+        elif not crop_first:
             image = np.copy(image)
 
+        if crop_first:
+            if self.shape is None or resized:
+                shape = image.shape[0:2]
+            else:
+                shape = self.shape[0:2]
+
+            if self.patch_size is not None:
+                image = self._crop(image, shape, self.patch_size)
+            else:
+                image = self._crop(image, shape, self.sample_size)
+        else:
+            image = self._resize_and_crop(image, resized)
+
+        if self.normalize and image.dtype == np.dtype('uint8'):
+            image = _normalize(image, self.dtype)
+
+        if self.grayscale and len(np.shape(image)) == 3 and np.shape(image)[2] >= 3:
+            image = _grayscale(image, self.dtype)
+
+        if self.noise is not None and not self.noise_before_resize:
+            self.noise.set_scale(self.scale)
+            self.noise.set_dtype(self.dtype)
+
+            image = self.noise.apply(image)
+
+        if self.keep_in_memory:
+            self.image = image
+
+        return image
+
+    def noisy(self, noise, noise_before_resize=True):
+        return Image(image=self.image, path=self.path, shape=self.shape, keep_in_memory=True, normalize=self.normalize,
+                     noise=noise, grayscale=self.grayscale, patch_size=self.patch_size, sample_size=self.sample_size,
+                     coordinates=self.coordinates, noise_before_resize=noise_before_resize, cache=self.cache,
+                     crop_first=self.crop_first, dtype=self.dtype, draft=self.draft)
+
+    def display(self, path=None, size=None):
+        image = self.get()
+
+        if len(image.shape) == 3 and image.shape[2] == 1:
+            image = np.squeeze(image, axis=(2,))
+
+        color_map = plt.cm.Greys_r if len(image.shape) == 2 else None
+
+        if size is not None:
+            image = misc.imresize(image, size)
+
+        if path is None:
+            plt.imshow(image, cmap=color_map)
+            plt.axis('off')
+            plt.show()
+        else:
+            plt.imsave(path, image, cmap=color_map)
+
+    def _resize_and_crop(self, image, resized):
         if self.noise is not None and self.noise_before_resize:
             if self.normalize and image.dtype == np.dtype('uint8'):
-                image = image / 255.
+                image = _normalize(image, self.dtype)
 
             self.noise.set_scale(self.scale)
+            self.noise.set_dtype(self.dtype)
 
             image = self.noise.apply(image)
 
-        if self.shape is not None:
+        if self.shape is not None and not resized:
             image = self._resize(image, self.shape)
 
         if self.patch_size is not None:
-            x = image.shape[0] * self.patch_size / np.min(image.shape[0:2])
-            y = image.shape[1] * self.patch_size / np.min(image.shape[0:2])
+            x = image.shape[0] * self.patch_size // np.min(image.shape[0:2])
+            y = image.shape[1] * self.patch_size // np.min(image.shape[0:2])
 
             image = self._resize(image, (x, y))
 
@@ -94,8 +166,8 @@ class Image:
 
         if self.sample_size is not None:
             if image.shape[0] < self.sample_size or image.shape[1] < self.sample_size:
-                x = image.shape[0] * self.sample_size / np.min(image.shape[0:2])
-                y = image.shape[1] * self.sample_size / np.min(image.shape[0:2])
+                x = image.shape[0] * self.sample_size // np.min(image.shape[0:2])
+                y = image.shape[1] * self.sample_size // np.min(image.shape[0:2])
 
                 image = self._resize(image, (x, y))
 
@@ -109,58 +181,150 @@ class Image:
 
             image = image[x:(x + self.sample_size), y:(y + self.sample_size)]
 
-        if self.normalize and image.dtype == np.dtype('uint8'):
-            image = image / 255.
+        return image
 
-        if self.grayscale and len(np.shape(image)) == 3 and np.shape(image)[2] >= 3:
-            r, g, b = image[:, :, 0], image[:, :, 1], image[:, :, 2]
+    def _crop(self, image, shape, size):
+        if self.patch_size is not None or shape[0] < size or shape[1] < size:
+            shape = (shape[0] * size // min(shape), shape[1] * size // min(shape))
 
-            image = 0.2989 * r + 0.5870 * g + 0.1140 * b
+        if self.coordinates is not None:
+            x, y = self.coordinates
+        else:
+            x = np.random.randint(shape[0] - size + 1)
+            y = np.random.randint(shape[1] - size + 1)
+
+            self.coordinates = (x, y)
+
+        scale_x = image.shape[0] / float(shape[0])
+        scale_y = image.shape[1] / float(shape[1])
+
+        top, bottom = int(np.floor(x * scale_x)), int(np.ceil((x + size) * scale_x))
+        left, right = int(np.floor(y * scale_y)), int(np.ceil((y + size) * scale_y))
+
+        image = np.array(image[top:bottom, left:right])
+
+        if self.noise is not None and self.noise_before_resize:
+            if self.normalize and image.dtype == np.dtype('uint8'):
+                image = _normalize(image, self.dtype)
 
-        if self.noise is not None and not self.noise_before_resize:
             self.noise.set_scale(self.scale)
+            self.noise.set_dtype(self.dtype)
 
             image = self.noise.apply(image)
 
-        if self.keep_in_memory:
-            self.image = image
+        if image.shape[0:2] != (size, size):
+            image = self._resize(image, (size, size))
 
         return image
 
-    def noisy(self, noise, noise_before_resize=True):
-        return Image(image=self.image, path=self.path, shape=self.shape, keep_in_memory=True, normalize=self.normalize,
-                     noise=noise, grayscale=self.grayscale, patch_size=self.patch_size, sample_size=self.sample_size,
-                     coordinates=self.coordinates, noise_before_resize=noise_before_resize)
+    def _decode(self):
+        if self.noise is not None and self.noise_before_resize:
+            shape = None
+        else:
+            shape = self.shape
 
-    def display(self, path=None, size=None):
-        image = self.get()
+        if self.cache is None:
+            if self.draft and self.shape is None and (self.noise is None or not self.noise_before_resize):
+                return decode(self.path, size=self.patch_size), False
 
-        if len(image.shape) == 3 and image.shape[2] == 1:
-            image = np.squeeze(image, axis=(2,))
+            return decode(self.path, shape=shape if self.draft else None), False
 
-        color_map = plt.cm.Greys_r if len(image.shape) == 2 else None
+        key = self.cache.key(self.path, shape, self.grayscale, self.normalize, self.draft)
+        image = self.cache.get(key)
 
-        if size is not None:
-            image = misc.imresize(image, size)
+        if image is None:
+            image = decode(self.path, shape=shape if self.draft else None)
 
-        if path is None:
-            plt.imshow(image, cmap=color_map)
-            plt.axis('off')
-            plt.show()
-        else:
-            plt.imsave(path, image, cmap=color_map)
+            if shape is not None:
+                image = resize(image, shape)
 
-    def _resize(self, image, shape):
-        image = misc.imresize(image, shape)
+            self.cache.put(key, image)
 
+        return image, shape is not None
+
+    def _resize(self, image, shape):
         if self.normalize and image.dtype == np.dtype('uint8'):
-            image = image / 255.
+            return _normalize(resize(image, shape, dtype=self.dtype), self.dtype)
+        else:
+            return resize(image, shape)
 
-        return image
+
+def _normalize(image, dtype):
+    return np.multiply(image, 1 / 255., dtype=dtype)
+
+
+def _grayscale(image, dtype):
+    image = np.asarray(image, dtype=dtype)
+
+    return 0.2989 * image[..., 0] + 0.5870 * image[..., 1] + 0.1140 * image[..., 2]
+
+
+def _scale(images):
+    if isinstance(images, ImageCollection):
+        return images.scale
+    else:
+        return images[0].scale
+
+
+class ImageCollection:
+    def __init__(self, images, shape=None, normalize=True, grayscale=False, indices=None, dtype=DEFAULT_DTYPE,
+                 transpose=None):
+        self.images = images
+        self.shape = shape
+        self.normalize = normalize
+        self.scale = (0.0, 1.0) if normalize else (0, 255)
+        self.grayscale = grayscale
+        self.dtype = dtype
+        self.transpose = transpose
+
+        if indices is None:
+            self.indices = np.arange(len(images))
+        else:
+            self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            image = self.images[self.indices[index]]
+
+            if self.transpose is not None:
+                image = np.transpose(image, [axis - 1 for axis in self.transpose[1:]])
+
+            return Image(image=image, shape=self.shape, normalize=self.normalize, grayscale=self.grayscale,
+                         dtype=self.dtype)
+        else:
+            return ImageCollection(self.images, shape=self.shape, normalize=self.normalize, grayscale=self.grayscale,
+                                   indices=self.indices[index], dtype=self.dtype, transpose=self.transpose)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def get(self):
+        images = self.images[self.indices]
+
+        if self.transpose is not None:
+            images = np.transpose(images, self.transpose)
+
+        if self.shape is not None:
+            if self.normalize:
+                images = resize_batch(images, self.shape, dtype=self.dtype)
+            else:
+                images = resize_batch(images, self.shape)
+
+        if self.normalize:
+            images = _normalize(images, self.dtype)
+
+        if self.grayscale and len(images.shape) == 4 and images.shape[3] >= 3:
+            images = _grayscale(images, self.dtype)
+
+        return images
 
 
 class Label:
-    def __init__(self, label, one_hot=True, dictionary=None, length=None):
+    def __init__(self, label, one_hot=True, dictionary=None, length=None, dtype=DEFAULT_DTYPE):
         if one_hot is True and dictionary is None and length is None:
             raise ValueError('If one_hot is true needs either dictionary or length')
 
@@ -171,7 +335,7 @@ class Label:
             if length is None:
                 length = len(dictionary)
 
-            self.label = np.zeros(length)
+            self.label = np.zeros(length, dtype=dtype)
             self.label[dictionary.index(label)] = 1
         else:
             self.label = label
@@ -181,33 +345,58 @@ class Label:
 
 
 class DataSet:
-    def __init__(self, images, targets=None, batch_size=50, cutoff=True, offset=None, shuffle=True):
+    def __init__(self, images, targets=None, batch_size=50, cutoff=True, offset=None, shuffle=True,
+                 dtype=DEFAULT_DTYPE, seed=None, shard_index=0, num_shards=1):
         assert targets is None or len(images) == len(targets)
+        assert 0 <= shard_index < num_shards
+
+        if num_shards > 1 and seed is None:
+            raise ValueError('Can\'t shard without a common seed')
 
-        self.images = np.array(images)
-        self.targets = np.array(targets) if targets else None
+        self.images = images if isinstance(images, ImageCollection) else np.array(images)
+        self.targets = np.asarray(targets) if targets is not None else None
         self.batch_size = batch_size
         self.offset = offset
-        self.length = len(images)
+        self.dtype = dtype
+        self.seed = seed if seed is not None else np.random.randint(2 ** 31 - 1)
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self.size = len(images)
+        self.length = len(images) // num_shards
         self.batches_completed = 0
         self.epochs_completed = 0
         self.current_index = 0
 
-        if shuffle:
-            self.shuffle()
-
         if cutoff:
             self.length -= self.length % self.batch_size
-            self.images = self.images[:self.length]
 
-            if self.targets is not None:
-                self.targets = self.targets[:self.length]
+        if shuffle:
+            self.shuffle()
+        else:
+            self.order = np.arange(self.size)[shard_index::num_shards][:self.length]
 
     def batch(self, size=None):
+        return self._create_batch(*self._take(size))
+
+    def iterate_once(self, size=None):
+        for indices in self._fixed_batches(size):
+            yield self._create_batch(*self._select(indices))
+
+    def shuffle(self):
+        random_state = np.random.RandomState([self.seed, self.epochs_completed])
+
+        self.order = random_state.permutation(self.size)[self.shard_index::self.num_shards][:self.length]
+
+    def _take(self, size=None):
+        epoch = self.epochs_completed
+
+        return self._select(self._next(size), epoch)
+
+    def _next(self, size=None):
         if size is None:
             size = self.batch_size
 
-        images, targets = self._create_batch(size)
+        indices = self.order[self.current_index:(self.current_index + size)]
 
         self.batches_completed += 1
         self.current_index += size
@@ -218,115 +407,359 @@ class DataSet:
 
             self.shuffle()
 
-        return images, targets
+        return indices
 
-    def shuffle(self):
-        perm = np.random.permutation(self.length)
+    def _fixed_batches(self, size=None):
+        if size is None:
+            size = self.batch_size
+
+        order = np.arange(self.size)[self.shard_index::self.num_shards]
+
+        return [order[i:(i + size)] for i in range(0, len(order), size)]
+
+    def _select(self, indices, epoch=0):
+        noise = getattr(self, 'noise', None)
 
-        self.images = self.images[perm]
+        if noise is not None and noise.per_sample():
+            noises = [noise.for_sample(epoch, index) for index in indices]
+        else:
+            noises = None
 
-        if self.targets is not None:
-            self.targets = self.targets[perm]
+        if self.targets is None:
+            return self.images[indices], None, noises
+        else:
+            return self.images[indices], self.targets[indices], noises
 
-    def _create_batch(self, size):
+    def _create_batch(self, images, targets, noises=None):
         raise NotImplementedError
 
+    def _apply_batch_noise(self, images, scale, noises=None):
+        if noises is None:
+            self.noise.set_scale(scale)
+            self.noise.set_dtype(self.dtype)
+
+            return self.noise.apply_batch(images)
+
+        noisy = np.empty(images.shape, dtype=self.dtype)
+
+        for i, noise in enumerate(noises):
+            noise.set_scale(scale)
+            noise.set_dtype(self.dtype)
+
+            noisy[i] = noise.apply(images[i])
+
+        return noisy
+
 
 class LabeledDataSet(DataSet):
     def __init__(self, images, targets, noise=None, patch=None, batch_size=50, cutoff=True, offset=None,
-                 noise_before_resize=True, shuffle=True, network=None):
+                 noise_before_resize=True, shuffle=True, network=None, network_batch_size=None, classes=None,
+                 sparse=False, dtype=DEFAULT_DTYPE, seed=None, shard_index=0, num_shards=1):
+        if classes is None and np.asarray(targets).dtype != np.dtype('O'):
+            classes = int(np.max(targets)) + 1
+
+        self.classes = classes
+        self.sparse = sparse
         self.noise = noise
         self.patch = patch
         self.noise_before_resize = noise_before_resize
         self.network = network
+        self.network_batch_size = network_batch_size
+
+        DataSet.__init__(self, images, targets, batch_size=batch_size, cutoff=cutoff, offset=offset, shuffle=shuffle,
+                         dtype=dtype, seed=seed, shard_index=shard_index, num_shards=num_shards)
+
+    def _create_batch(self, images, targets, noises=None):
+        batch_noise = self.network is None and self.noise is not None and not self.noise_before_resize
+        scale = _scale(images)
+
+        if self.network is not None:
+            images = self._denoise(images, noises)
+        elif self.noise is not None and not batch_noise:
+            noises = noises or [self.noise] * len(images)
+            images = [image.noisy(noise, self.noise_before_resize).patch(self.patch)
+                      for image, noise in zip(images, noises)]
+        elif self.patch is None and isinstance(images, ImageCollection):
+            images = images.get()
+        else:
+            images = [image.patch(self.patch) for image in images]
+
+        if targets.dtype == np.dtype('O'):
+            targets = np.asarray([target.get() for target in targets], dtype=self.dtype)
+        elif not self.sparse:
+            labels = targets
+            targets = np.zeros((len(labels), self.classes), dtype=self.dtype)
+            targets[np.arange(len(labels)), labels] = 1
+
+        images = np.asarray(images, dtype=self.dtype)
 
-        DataSet.__init__(self, images, targets, batch_size=batch_size, cutoff=cutoff, offset=offset, shuffle=shuffle)
+        if batch_noise:
+            images = self._apply_batch_noise(images, scale, noises)
+
+        if self.offset is not None:
+            images -= np.array(self.offset, ndmin=1).astype(images.dtype)
+
+        return images, targets
+
+    def _denoise(self, images, noises=None):
+        images = list(images)
 
-    def _create_batch(self, size):
         if self.noise is not None:
-            images = []
+            noises = noises or [self.noise] * len(images)
+            images = [image.noisy(noise, self.noise_before_resize) for image, noise in zip(images, noises)]
 
-            for image in self.images[self.current_index:(self.current_index + size)]:
-                if self.network is None:
-                    images.append(image.noisy(self.noise, self.noise_before_resize).patch(self.patch))
-                else:
-                    noisy = image.noisy(self.noise, self.noise_before_resize)
+        pixels = [image.get() for image in images]
+        groups = collections.OrderedDict()
+        denoised = [None] * len(images)
 
-                    if image.normalize:
-                        denoised = self.network.output().eval(feed_dict={self.network.x: [noisy.get()]})[0]
-                    else:
-                        denoisable = noisy.get().astype(np.float) / 255.0
-                        denoised = self.network.output().eval(feed_dict={self.network.x: [denoisable]})[0]
-                        denoised = np.clip(denoised * 255, 0, 255).astype(np.uint8)
+        for i in range(len(pixels)):
+            groups.setdefault(np.shape(pixels[i]), []).append(i)
 
-                    images.append(Image(image=denoised, normalize=image.normalize, grayscale=image.grayscale).patch(self.patch))
-        elif self.network is not None:
-            images = []
+        for indices in groups.values():
+            chunk = self.network_batch_size or len(indices)
 
-            for image in self.images[self.current_index:(self.current_index + size)]:
-                if image.normalize:
-                    denoised = self.network.output().eval(feed_dict={self.network.x: [image.get()]})[0]
-                else:
-                    denoisable = image.get().astype(np.float) / 255.0
-                    denoised = self.network.output().eval(feed_dict={self.network.x: [denoisable]})[0]
-                    denoised = np.clip(denoised * 255, 0, 255).astype(np.uint8)
+            for i in range(0, len(indices), chunk):
+                selected = indices[i:(i + chunk)]
+                normalize = images[selected[0]].normalize
+                x = np.array([pixels[j] for j in selected], dtype=self.dtype)
 
-                images.append(Image(image=denoised, normalize=image.normalize, grayscale=image.grayscale).patch(self.patch))
-        else:
-            images = [image.patch(self.patch) for image in self.images[self.current_index:(self.current_index + size)]]
+                if not normalize:
+                    x /= 255.0
 
-        targets = [target.get() for target in self.targets[self.current_index:(self.current_index + size)]]
+                y = self.network.output().eval(feed_dict={self.network.x: x})
 
-        images, targets = np.array(images), np.array(targets)
+                if not normalize:
+                    y = np.clip(y * 255, 0, 255).astype(np.uint8)
 
-        if self.offset is not None:
-            images -= np.array(self.offset, ndmin=1).astype(images.dtype)
+                for j, image in zip(selected, y):
+                    denoised[j] = image
 
-        return images, targets
+        return [Image(image=denoised[i], normalize=images[i].normalize, grayscale=images[i].grayscale,
+                      patch_size=self.patch, crop_first=images[i].crop_first, dtype=self.dtype).get()
+                for i in range(len(images))]
 
 
 class UnlabeledDataSet(DataSet):
     def __init__(self, images, noise=None, patch=None, sample=None, batch_size=50, cutoff=True, offset=None,
-                 noise_before_resize=True, shuffle=True):
+                 noise_before_resize=True, shuffle=True, dtype=DEFAULT_DTYPE, seed=None, shard_index=0,
+                 num_shards=1):
         self.noise = noise
         self.patch = patch
         self.sample = sample
         self.noise_before_resize = noise_before_resize
 
-        DataSet.__init__(self, images, batch_size=batch_size, cutoff=cutoff, offset=offset, shuffle=shuffle)
+        DataSet.__init__(self, images, batch_size=batch_size, cutoff=cutoff, offset=offset, shuffle=shuffle,
+                         dtype=dtype, seed=seed, shard_index=shard_index, num_shards=num_shards)
 
-    def _create_batch(self, size):
-        images = []
-        targets = []
+    def _create_batch(self, images, targets, noises=None):
+        batch_noise = self.noise is not None and not self.noise_before_resize
+        scale = _scale(images)
 
-        for i in range(size):
-            if self.current_index + i >= self.length:
-                break
+        if not (self.patch or self.sample) and (self.noise is None or batch_noise) and \
+                isinstance(images, ImageCollection):
+            targets = np.asarray(images.get(), dtype=self.dtype)
+            images = targets if batch_noise else np.copy(targets)
+        else:
+            batch = images
+            images = []
+            targets = []
 
-            target = self.images[self.current_index + i]
+            for i, target in enumerate(batch):
+                if self.noise is not None and not batch_noise:
+                    image = target.noisy(noises[i] if noises else self.noise, self.noise_before_resize)
+                else:
+                    image = target
+
+                if self.patch:
+                    patch, coordinates = image.patch(self.patch, return_coordinates=True)
+                    target = patch if image is target else target.patch(self.patch, coordinates=coordinates)
+                    image = patch
+                elif self.sample:
+                    sample, coordinates = image.sample(self.sample, return_coordinates=True)
+                    target = sample if image is target else target.sample(self.sample, coordinates=coordinates)
+                    image = sample
+                else:
+                    image = image.get()
+                    target = target.get()
 
-            if self.noise:
-                image = target.noisy(self.noise, self.noise_before_resize)
-            else:
-                image = target
-
-            if self.patch:
-                image, coordinates = image.patch(self.patch, return_coordinates=True)
-                target = target.patch(self.patch, coordinates=coordinates)
-            elif self.sample:
-                image, coordinates = image.sample(self.sample, return_coordinates=True)
-                target = target.sample(self.sample, coordinates=coordinates)
-            else:
-                image = image.get()
-                target = target.get()
+                images.append(image)
+                targets.append(target)
 
-            images.append(image)
-            targets.append(target)
+            images, targets = np.asarray(images, dtype=self.dtype), np.asarray(targets, dtype=self.dtype)
 
-        images, targets = np.array(images), np.array(targets)
+        if batch_noise:
+            images = self._apply_batch_noise(targets, scale, noises)
 
         if self.offset is not None:
             images -= np.array(self.offset, ndmin=1).astype(images.dtype)
             targets -= np.array(self.offset, ndmin=1).astype(targets.dtype)
 
         return images, targets
+
+
+class PrefetchingDataSet:
+    def __init__(self, dataset, prefetch=4, workers=4):
+        self.dataset = dataset
+        self.prefetch = prefetch
+        self.batch_size = dataset.batch_size
+        self.length = dataset.length
+        self.batches_completed = 0
+        self.epochs_completed = 0
+        self.current_index = 0
+        self.pool = ThreadPool(workers)
+        self.pending = collections.deque()
+
+    def __getattr__(self, name):
+        return getattr(self.dataset, name)
+
+    def batch(self, size=None):
+        if size is not None and size != self.batch_size:
+            raise ValueError('Can\'t prefetch batches of size other than batch_size')
+
+        self._fill()
+
+        result, epoch_completed = self.pending.popleft()
+
+        self._fill()
+
+        images, targets = result.get()
+
+        self.batches_completed += 1
+        self.current_index += self.batch_size
+
+        if epoch_completed:
+            self.current_index = 0
+            self.epochs_completed += 1
+
+        return images, targets
+
+    def iterate_once(self, size=None):
+        tasks = [self.dataset._select(indices) for indices in self.dataset._fixed_batches(size)]
+
+        return _prefetched(self.pool, self.dataset._create_batch, tasks, self.prefetch)
+
+    def close(self):
+        self.pool.terminate()
+
+    def _fill(self):
+        while len(self.pending) < self.prefetch:
+            epochs_completed = self.dataset.epochs_completed
+            result = self.pool.apply_async(self.dataset._create_batch, self.dataset._take())
+
+            self.pending.append((result, self.dataset.epochs_completed != epochs_completed))
+
+
+class ParallelDataSet:
+    # Batches are returned as views into shared memory that stay valid until the next call to batch().
+
+    def __init__(self, dataset, workers=4, slots=8):
+        if slots < 2:
+            raise ValueError('Needs at least two slots')
+
+        self.dataset = dataset
+        self.slots = slots
+        self.batch_size = dataset.batch_size
+        self.length = dataset.length
+        self.batches_completed = 0
+        self.epochs_completed = 0
+        self.current_index = 0
+
+        images, targets = dataset._create_batch(*dataset._select(dataset.order[:self.batch_size]))
+
+        self.images, images_buffer = _shared_ring(slots, self.batch_size, images)
+        self.targets, targets_buffer = _shared_ring(slots, self.batch_size, targets)
+        self.pool = multiprocessing.Pool(workers, initializer=_initialize_worker,
+                                         initargs=(dataset, images_buffer, targets_buffer, self.images.shape,
+                                                   self.images.dtype, self.targets.shape, self.targets.dtype))
+        self.free = collections.deque(range(slots))
+        self.pending = collections.deque()
+        self.held = None
+
+    def __getattr__(self, name):
+        return getattr(self.dataset, name)
+
+    def batch(self, size=None):
+        if size is not None and size != self.batch_size:
+            raise ValueError('Can\'t prefetch batches of size other than batch_size')
+
+        if self.held is not None:
+            self.free.append(self.held)
+
+        self._fill()
+
+        result, epoch_completed = self.pending.popleft()
+        slot, n = result.get()
+
+        self.held = slot
+        self.batches_completed += 1
+        self.current_index += self.batch_size
+
+        if epoch_completed:
+            self.current_index = 0
+            self.epochs_completed += 1
+
+        return self.images[slot][:n], self.targets[slot][:n]
+
+    def iterate_once(self, size=None):
+        tasks = [(indices,) for indices in self.dataset._fixed_batches(size)]
+
+        return _prefetched(self.pool, _create_batch, tasks, self.slots)
+
+    def close(self):
+        self.pool.terminate()
+
+    def _fill(self):
+        while len(self.free) > 0:
+            epochs_completed = self.dataset.epochs_completed
+            indices = self.dataset._next()
+            result = self.pool.apply_async(_fill_slot, (self.free.popleft(), indices, epochs_completed))
+
+            self.pending.append((result, self.dataset.epochs_completed != epochs_completed))
+
+
+def _prefetched(pool, function, tasks, prefetch):
+    pending = collections.deque()
+
+    for task in tasks:
+        pending.append(pool.apply_async(function, task))
+
+        if len(pending) > prefetch:
+            yield pending.popleft().get()
+
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+def _shared_ring(slots, size, batch):
+    shape = (slots, size) + batch.shape[1:]
+    buffer = multiprocessing.RawArray('b', int(np.prod(shape)) * batch.dtype.itemsize)
+
+    return np.frombuffer(buffer, dtype=batch.dtype).reshape(shape), buffer
+
+
+_worker = {}
+
+
+def _initialize_worker(dataset, images_buffer, targets_buffer, images_shape, images_dtype, targets_shape,
+                       targets_dtype):
+    np.random.seed()
+
+    _worker['dataset'] = dataset
+    _worker['images'] = np.frombuffer(images_buffer, dtype=images_dtype).reshape(images_shape)
+    _worker['targets'] = np.frombuffer(targets_buffer, dtype=targets_dtype).reshape(targets_shape)
+
+
+def _fill_slot(slot, indices, epoch):
+    dataset = _worker['dataset']
+    images, targets = dataset._create_batch(*dataset._select(indices, epoch))
+
+    _worker['images'][slot][:len(images)] = images
+    _worker['targets'][slot][:len(targets)] = targets
+
+    return slot, len(images)
+
+
+def _create_batch(indices):
+    dataset = _worker['dataset']
+
+    return dataset._create_batch(*dataset._select(indices))
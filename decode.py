@@ -0,0 +1,30 @@
+import numpy as np
+
+from multiprocessing.pool import ThreadPool
+from PIL import Image as PILImage
+
+
+def decode(path, shape=None, size=None):
+    image = PILImage.open(path)
+
+    if shape is not None or size is not None:
+        width, height = image.size
+
+        if shape is not None:
+            request = (int(shape[1]), int(shape[0]))
+        else:
+            short = min(width, height)
+            request = (-(-width * size // short), -(-height * size // short))
+
+        image.draft('RGB', request)
+
+    return np.array(image.convert('RGB'))
+
+
+def preload(images, workers=8):
+    pool = ThreadPool(workers)
+
+    try:
+        pool.map(lambda image: image.get(), images, chunksize=max(1, len(images) // (workers * 4)))
+    finally:
+        pool.terminate()
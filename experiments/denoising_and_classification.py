@@ -84,17 +84,17 @@ with tf.Session() as sess:
                                                        noise=eval(params['test_noise']), network=denoising_network)
 
     scores = []
-    initial_epoch = val_set.epochs_completed
+    sizes = []
 
-    while initial_epoch == val_set.epochs_completed:
-        x, y_ = val_set.batch()
+    for x, y_ in val_set.iterate_once():
         scores.append(score.eval(feed_dict={classification_network.x: x, classification_network.y_: y_,
                                             classification_network.keep_prob: 1.0}))
+        sizes.append(len(x))
 
     case = '%s2%s' % (params['train_noise'], params['test_noise'])
 
     results = {
-        case: str(np.round(np.mean(scores), 4))
+        case: str(np.round(np.average(scores, weights=sizes), 4))
     }
 
     print(results)
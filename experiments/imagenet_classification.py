@@ -6,6 +6,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import models
 import trainers
 import loaders
+import containers
 import tensorflow as tf
 import argparse
 
@@ -80,4 +81,4 @@ if __name__ == '__main__':
                                                        normalize=params['normalize'], offset=params['offset'],
                                                        train_noise=train_noise, test_noise=test_noise)
 
-    trainer.train(train_set, val_set=val_set, test_set=val_set)
+    trainer.train(containers.PrefetchingDataSet(train_set), val_set=val_set, test_set=val_set)
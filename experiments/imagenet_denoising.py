@@ -6,6 +6,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import models
 import trainers
 import loaders
+import containers
 import tensorflow as tf
 import numpy as np
 import argparse
@@ -109,4 +110,4 @@ if __name__ == '__main__':
                                                          normalize=params['normalize'], offset=params['offset'],
                                                          noise=noise)
 
-    trainer.train(train_set, val_set=val_set, test_set=val_set)
+    trainer.train(containers.PrefetchingDataSet(train_set), val_set=val_set, test_set=val_set)
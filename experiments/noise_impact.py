@@ -68,15 +68,15 @@ with tf.Session() as sess:
                                                        noise_before_resize=True)
 
             scores = []
-            initial_epoch = val_set.epochs_completed
+            sizes = []
 
-            while initial_epoch == val_set.epochs_completed:
-                x, y_ = val_set.batch()
+            for x, y_ in val_set.iterate_once():
                 scores.append(score.eval(feed_dict={network.x: x, network.y_: y_, network.keep_prob: 1.0}))
+                sizes.append(len(x))
 
-            results[noise].append(np.round(np.mean(scores), 2))
+            results[noise].append(np.round(np.average(scores, weights=sizes), 2))
 
-            print('Noise: %s, value: %s, score: %s' % (noise, value, np.round(np.mean(scores), 2)))
+            print('Noise: %s, value: %s, score: %s' % (noise, value, np.round(np.average(scores, weights=sizes), 2)))
 
 
 with open(os.path.join(os.path.dirname(__file__), '..', 'results', 'noise_impact.json'), 'w') as fp:
@@ -1,18 +1,52 @@
 import os
 import urllib
+import gzip
+import shutil
 import tarfile
 import numpy as np
 import pandas as pd
+import PIL.Image
 
-from containers import Image, Label, LabeledDataSet, UnlabeledDataSet
+from containers import Image, ImageCollection, LabeledDataSet, UnlabeledDataSet
+from records import RecordArray
+from decode import preload as preload_images
 
 
 ROOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 
 
-def _download_stl():
+STL_RECORD_SIZE = 3 * 96 * 96
+
+
+def _download_stl(extract=True):
     stl_path = os.path.join(ROOT_PATH, 'STL-10')
     data_path = os.path.join(stl_path, 'stl10_binary')
+    archive_path = os.path.join(stl_path, 'stl10_binary.tar')
+
+    if extract and os.path.exists(data_path):
+        return data_path
+
+    if not extract and os.path.exists(archive_path):
+        return archive_path
+
+    tar_path = _download_stl_archive()
+
+    if extract:
+        with tarfile.open(tar_path) as tar:
+            tar.extractall(stl_path)
+
+        return data_path
+
+    with gzip.open(tar_path, 'rb') as source, open(archive_path + '.part', 'wb') as target:
+        shutil.copyfileobj(source, target, 2 ** 24)
+
+    os.rename(archive_path + '.part', archive_path)
+
+    return archive_path
+
+
+def _download_stl_archive():
+    stl_path = os.path.join(ROOT_PATH, 'STL-10')
     tar_path = os.path.join(stl_path, 'stl10_binary.tar.gz')
     url = 'http://ai.stanford.edu/~acoates/stl10/stl10_binary.tar.gz'
 
@@ -22,71 +56,83 @@ def _download_stl():
     if not os.path.exists(stl_path):
         os.makedirs(stl_path)
 
-    if not os.path.exists(data_path):
-        if not os.path.exists(tar_path):
-            urllib.urlretrieve(url, tar_path)
+    if not os.path.exists(tar_path):
+        urllib.urlretrieve(url, tar_path)
 
-        with tarfile.open(tar_path) as tar:
-            tar.extractall(stl_path)
+    return tar_path
 
-    return data_path
 
+def _stl_member(path, extract=True):
+    data_path = _download_stl(extract)
 
-def _load_stl_images(path, shape, grayscale):
-    stl_path = os.path.join(ROOT_PATH, 'STL-10')
-    data_path = os.path.join(stl_path, 'stl10_binary')
+    if extract:
+        return os.path.join(data_path, path), 0, os.path.getsize(os.path.join(data_path, path))
 
-    result = []
+    with tarfile.open(data_path) as tar:
+        member = tar.getmember('stl10_binary/%s' % path)
 
-    with open(os.path.join(data_path, path), 'rb') as f:
-        everything = np.fromfile(f, dtype=np.uint8)
+    return data_path, member.offset_data, member.size
 
-        images = np.reshape(everything, (-1, 3, 96, 96))
-        images = np.transpose(images, (0, 3, 2, 1))
 
-    for image in images:
-        result.append(Image(image=image, shape=shape, keep_in_memory=True, grayscale=grayscale))
+def _load_stl_images(path, shape, grayscale, extract=True):
+    path, offset, size = _stl_member(path, extract)
 
-    return result
+    images = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(size // STL_RECORD_SIZE, 3, 96, 96))
 
+    return ImageCollection(images, shape=shape, grayscale=grayscale, transpose=(0, 3, 2, 1))
 
-def _load_stl_targets(path):
-    stl_path = os.path.join(ROOT_PATH, 'STL-10')
-    data_path = os.path.join(stl_path, 'stl10_binary')
 
-    result = []
+def _load_stl_targets(path, extract=True):
+    path, offset, size = _stl_member(path, extract)
 
-    with open(os.path.join(data_path, path), 'rb') as f:
-        labels = np.fromfile(f, dtype=np.uint8)
+    labels = np.array(np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(size,)))
 
-    for label in labels:
-        result.append(Label(label - 1, length=10))
+    return labels.astype(np.int16) - 1
 
-    return result
 
+def stream_stl_images(path='unlabeled_X.bin', chunk=1000):
+    with tarfile.open(_download_stl_archive(), 'r|gz') as tar:
+        for member in tar:
+            if member.name != 'stl10_binary/%s' % path:
+                continue
 
-def load_stl_labeled(batch_size=50, shape=None, grayscale=False):
-    _download_stl()
+            f = tar.extractfile(member)
 
-    train_images = _load_stl_images('train_X.bin', shape, grayscale)
-    test_images = _load_stl_images('test_X.bin', shape, grayscale)
-    train_targets = _load_stl_targets('train_y.bin')
-    test_targets = _load_stl_targets('test_y.bin')
+            while True:
+                data = f.read(STL_RECORD_SIZE * chunk)
 
-    train_set = LabeledDataSet(train_images, train_targets, batch_size)
-    test_set = LabeledDataSet(test_images, test_targets, batch_size)
+                if not data:
+                    return
 
-    return train_set, test_set
+                yield np.frombuffer(data, dtype=np.uint8).reshape((-1, 3, 96, 96)).transpose((0, 3, 2, 1))
 
+    raise ValueError('Can\'t find %s in the STL-10 archive' % path)
 
-def load_stl_unlabeled(batch_size=50, shape=None, grayscale=False, noise=None, patch=None):
-    _download_stl()
 
-    train_images = _load_stl_images('unlabeled_X.bin', shape, grayscale)
-    test_images = _load_stl_images('train_X.bin', shape, grayscale)
+def load_stl_labeled(batch_size=50, shape=None, grayscale=False, seed=None, shard_index=0, num_shards=1,
+                     extract=True):
+    train_images = _load_stl_images('train_X.bin', shape, grayscale, extract)
+    test_images = _load_stl_images('test_X.bin', shape, grayscale, extract)
+    train_targets = _load_stl_targets('train_y.bin', extract)
+    test_targets = _load_stl_targets('test_y.bin', extract)
 
-    train_set = UnlabeledDataSet(train_images, noise=noise, patch=patch, batch_size=batch_size)
-    test_set = UnlabeledDataSet(test_images, patch=patch, batch_size=batch_size)
+    train_set = LabeledDataSet(train_images, train_targets, batch_size=batch_size, classes=10, seed=seed,
+                               shard_index=shard_index, num_shards=num_shards)
+    test_set = LabeledDataSet(test_images, test_targets, batch_size=batch_size, classes=10, seed=seed,
+                              shard_index=shard_index, num_shards=num_shards)
+
+    return train_set, test_set
+
+
+def load_stl_unlabeled(batch_size=50, shape=None, grayscale=False, noise=None, patch=None, seed=None, shard_index=0,
+                       num_shards=1, extract=True):
+    train_images = _load_stl_images('unlabeled_X.bin', shape, grayscale, extract)
+    test_images = _load_stl_images('train_X.bin', shape, grayscale, extract)
+
+    train_set = UnlabeledDataSet(train_images, noise=noise, patch=patch, batch_size=batch_size, seed=seed,
+                                 shard_index=shard_index, num_shards=num_shards)
+    test_set = UnlabeledDataSet(test_images, patch=patch, batch_size=batch_size, seed=seed, shard_index=shard_index,
+                                num_shards=num_shards)
 
     return train_set, test_set
 
@@ -98,100 +144,164 @@ def _imagenet_path(element=None):
         return os.path.join(ROOT_PATH, 'ImageNet')
 
 
-def _load_imagenet_images(dataset, shape, grayscale, normalize=True, n=None):
+def _download_imagenet_csv(name):
+    if not os.path.exists(_imagenet_path(name)):
+        url = 'https://raw.githubusercontent.com/michalkoziarski/datasets/master/ImageNet/%s' % name
+        urllib.urlretrieve(url, _imagenet_path(name))
+
+    return pd.read_csv(_imagenet_path(name))
+
+
+def build_imagenet_manifest(dataset):
     assert os.path.exists(_imagenet_path(dataset))
 
-    result = []
+    paths = []
+    heights = []
+    widths = []
 
     for (dirpath, _, filenames) in os.walk(_imagenet_path(dataset)):
         for filename in filenames:
-            path = os.path.join(ROOT_PATH, 'ImageNet', dirpath, filename)
-            result.append(Image(path=path, shape=shape, keep_in_memory=False, grayscale=grayscale, normalize=normalize))
+            path = os.path.join(dirpath, filename)
+            image = PIL.Image.open(path)
+            width, height = image.size
+            image.close()
 
-            if n is not None and len(result) >= n:
-                return result
+            paths.append(os.path.relpath(path, _imagenet_path()))
+            heights.append(height)
+            widths.append(width)
 
-    return result
+    manifest = pd.DataFrame({'path': paths, 'height': heights, 'width': widths})
+    filenames = [os.path.split(path)[-1] for path in paths]
 
+    if dataset == 'train':
+        manifest['WNID'] = [filename.split('_')[0] for filename in filenames]
+        manifest = manifest.merge(_download_imagenet_csv('synsets.csv'), on='WNID', how='left')
+    else:
+        manifest['ID'] = [int(filename.split('.')[0].split('_')[-1]) for filename in filenames]
+        manifest = manifest.merge(_download_imagenet_csv('val_ground_truth.csv'), on='ID', how='left')
 
-def load_imagenet_labeled(batch_size=50, shape=None, grayscale=False, patch=None, normalize=True, offset=None,
-                          train_noise=None, test_noise=None, noise_before_resize=True):
-    assert os.path.exists(_imagenet_path())
+    manifest = manifest.rename(columns={'LABEL': 'label'})[['path', 'label', 'height', 'width']]
+
+    if manifest['label'].isnull().any():
+        raise ValueError('Can\'t find labels for %d %s images' % (manifest['label'].isnull().sum(), dataset))
+
+    manifest = manifest.sort_values('path')
+    manifest.to_csv(_imagenet_path('%s_manifest.csv' % dataset), index=False)
+
+    return manifest
+
+
+def _load_imagenet_manifest(dataset):
+    if not os.path.exists(_imagenet_path('%s_manifest.csv' % dataset)):
+        return build_imagenet_manifest(dataset)
+
+    return pd.read_csv(_imagenet_path('%s_manifest.csv' % dataset))
+
+
+def _load_imagenet_images(dataset, shape, grayscale, normalize=True, n=None, cache=None, crop_first=False, draft=False,
+                          preload=False):
+    manifest = _load_imagenet_manifest(dataset)
+
+    if n is not None:
+        manifest = manifest[:n]
 
-    for f in ['synsets.csv', 'val_ground_truth.csv']:
-        if not os.path.exists(_imagenet_path(f)):
-            url = 'https://raw.githubusercontent.com/michalkoziarski/datasets/master/ImageNet/%s' % f
-            urllib.urlretrieve(url, _imagenet_path(f))
+    images = [Image(path=_imagenet_path(path), shape=shape, keep_in_memory=preload, grayscale=grayscale,
+                    normalize=normalize, cache=cache, crop_first=crop_first, draft=draft) for path in manifest['path']]
 
-    synsets = pd.read_csv(_imagenet_path('synsets.csv'))
-    val_ground_truth = pd.read_csv(_imagenet_path('val_ground_truth.csv'))
+    if preload:
+        preload_images(images)
 
-    train_images = _load_imagenet_images('train', shape, grayscale, normalize=normalize)
-    val_images = _load_imagenet_images('val', shape, grayscale, normalize=normalize)
+    if manifest['label'].isnull().any():
+        raise ValueError('Can\'t find labels for %d %s images' % (manifest['label'].isnull().sum(), dataset))
 
-    train_targets = []
-    val_targets = []
+    targets = manifest['label'].values.astype(np.int16) - 1
 
-    for image in train_images:
-        wnid = os.path.split(image.path)[-1].split('_')[0]
-        label = int(synsets[synsets['WNID'] == wnid]['LABEL'])
-        train_targets.append(Label(label - 1, length=1000))
+    return images, targets
 
-    for image in val_images:
-        id = int(os.path.split(image.path)[-1].split('.')[0].split('_')[-1])
-        label = int(val_ground_truth[val_ground_truth['ID'] == id]['LABEL'])
-        val_targets.append(Label(label - 1, length=1000))
+
+def load_imagenet_labeled(batch_size=50, shape=None, grayscale=False, patch=None, normalize=True, offset=None,
+                          train_noise=None, test_noise=None, noise_before_resize=True, cache=None, crop_first=False,
+                          draft=False, preload=False, seed=None, shard_index=0, num_shards=1):
+    assert os.path.exists(_imagenet_path())
+
+    train_images, train_targets = _load_imagenet_images('train', shape, grayscale, normalize=normalize, cache=cache,
+                                                        crop_first=crop_first, draft=draft, preload=preload)
+    val_images, val_targets = _load_imagenet_images('val', shape, grayscale, normalize=normalize, cache=cache,
+                                                    crop_first=crop_first, draft=draft, preload=preload)
 
     train_set = LabeledDataSet(train_images, train_targets, patch=patch, batch_size=batch_size, noise=train_noise,
-                               offset=offset, noise_before_resize=noise_before_resize)
+                               offset=offset, noise_before_resize=noise_before_resize, classes=1000, seed=seed,
+                               shard_index=shard_index, num_shards=num_shards)
     val_set = LabeledDataSet(val_images, val_targets, patch=patch, batch_size=batch_size, noise=test_noise,
-                             offset=offset, noise_before_resize=noise_before_resize)
+                             offset=offset, noise_before_resize=noise_before_resize, classes=1000, seed=seed,
+                             shard_index=shard_index, num_shards=num_shards)
 
     return train_set, val_set
 
 
 def load_imagenet_labeled_validation(batch_size=50, shape=None, grayscale=False, patch=None, normalize=True,
-                                     offset=None, noise=None, noise_before_resize=True, network=None, n=None):
+                                     offset=None, noise=None, noise_before_resize=True, network=None, n=None,
+                                     cache=None, crop_first=False, draft=False, preload=False, network_batch_size=None,
+                                     seed=None, shard_index=0, num_shards=1):
     assert os.path.exists(_imagenet_path())
 
-    if not os.path.exists(_imagenet_path('val_ground_truth.csv')):
-        url = 'https://raw.githubusercontent.com/michalkoziarski/datasets/master/ImageNet/val_ground_truth.csv'
-        urllib.urlretrieve(url, _imagenet_path('val_ground_truth.csv'))
-
-    val_ground_truth = pd.read_csv(_imagenet_path('val_ground_truth.csv'))
-
-    val_images = _load_imagenet_images('val', shape, grayscale, normalize=normalize, n=n)
-    val_targets = []
-
-    for image in val_images:
-        id = int(os.path.split(image.path)[-1].split('.')[0].split('_')[-1])
-        label = int(val_ground_truth[val_ground_truth['ID'] == id]['LABEL'])
-        val_targets.append(Label(label - 1, length=1000))
+    val_images, val_targets = _load_imagenet_images('val', shape, grayscale, normalize=normalize, n=n, cache=cache,
+                                                    crop_first=crop_first, draft=draft, preload=preload)
 
     val_set = LabeledDataSet(val_images, val_targets, patch=patch, batch_size=batch_size, noise=noise, offset=offset,
-                             noise_before_resize=noise_before_resize, network=network)
+                             noise_before_resize=noise_before_resize, network=network,
+                             network_batch_size=network_batch_size, classes=1000, seed=seed, shard_index=shard_index,
+                             num_shards=num_shards)
 
     return val_set
 
 
 def load_imagenet_unlabeled(batch_size=50, shape=None, grayscale=False, noise=None, patch=None, sample=None,
-                            normalize=True, offset=None, noise_before_resize=True):
-    train_images = _load_imagenet_images('train', shape, grayscale, normalize=normalize)
-    val_images = _load_imagenet_images('val', shape, grayscale, normalize=normalize)
+                            normalize=True, offset=None, noise_before_resize=True, cache=None, crop_first=False,
+                            draft=False, preload=False, seed=None, shard_index=0, num_shards=1):
+    train_images, _ = _load_imagenet_images('train', shape, grayscale, normalize=normalize, cache=cache,
+                                            crop_first=crop_first, draft=draft, preload=preload)
+    val_images, _ = _load_imagenet_images('val', shape, grayscale, normalize=normalize, cache=cache,
+                                          crop_first=crop_first, draft=draft, preload=preload)
 
     train_set = UnlabeledDataSet(train_images, noise=noise, patch=patch, sample=sample, batch_size=batch_size,
-                                 offset=offset, noise_before_resize=noise_before_resize)
+                                 offset=offset, noise_before_resize=noise_before_resize, seed=seed,
+                                 shard_index=shard_index, num_shards=num_shards)
     val_set = UnlabeledDataSet(val_images, noise=noise, patch=patch, sample=sample, batch_size=batch_size,
-                               offset=offset, noise_before_resize=noise_before_resize)
+                               offset=offset, noise_before_resize=noise_before_resize, seed=seed,
+                               shard_index=shard_index, num_shards=num_shards)
 
     return train_set, val_set
 
 
 def load_imagenet_unlabeled_validation(batch_size=50, shape=None, grayscale=False, noise=None, patch=None, sample=None,
-                                       normalize=True, offset=None, noise_before_resize=True, shuffle=True, n=None):
-    val_images = _load_imagenet_images('val', shape, grayscale, normalize=normalize, n=n)
+                                       normalize=True, offset=None, noise_before_resize=True, shuffle=True, n=None,
+                                       cache=None, crop_first=False, draft=False, preload=False, seed=None,
+                                       shard_index=0, num_shards=1):
+    val_images, _ = _load_imagenet_images('val', shape, grayscale, normalize=normalize, n=n, cache=cache,
+                                          crop_first=crop_first, draft=draft, preload=preload)
 
     val_set = UnlabeledDataSet(val_images, noise=noise, patch=patch, sample=sample, batch_size=batch_size,
-                               offset=offset, noise_before_resize=noise_before_resize, shuffle=shuffle)
+                               offset=offset, noise_before_resize=noise_before_resize, shuffle=shuffle, seed=seed,
+                               shard_index=shard_index, num_shards=num_shards)
 
     return val_set
+
+
+def load_records_labeled(path, batch_size=50, grayscale=False, patch=None, normalize=True, offset=None, noise=None,
+                         noise_before_resize=True, seed=None, shard_index=0, num_shards=1):
+    records = RecordArray(path)
+    images = ImageCollection(records, normalize=normalize, grayscale=grayscale)
+
+    return LabeledDataSet(images, records.labels, patch=patch, batch_size=batch_size, noise=noise, offset=offset,
+                          noise_before_resize=noise_before_resize, classes=records.classes, seed=seed,
+                          shard_index=shard_index, num_shards=num_shards)
+
+
+def load_records_unlabeled(path, batch_size=50, grayscale=False, noise=None, patch=None, sample=None, normalize=True,
+                           offset=None, noise_before_resize=True, seed=None, shard_index=0, num_shards=1):
+    images = ImageCollection(RecordArray(path), normalize=normalize, grayscale=grayscale)
+
+    return UnlabeledDataSet(images, noise=noise, patch=patch, sample=sample, batch_size=batch_size, offset=offset,
+                            noise_before_resize=noise_before_resize, seed=seed, shard_index=shard_index,
+                            num_shards=num_shards)
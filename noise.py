@@ -1,14 +1,34 @@
+import os
+import copy
+import json
+import threading
 import numpy as np
-
-from scipy import ndimage
+import blur
 
 
 DEFAULT_SCALE = (0.0, 1.0)
+DEFAULT_DTYPE = np.float32
+MAX_SPARSE_DENSITY = 0.1
+
+_local = threading.local()
+
+
+def _default_generator():
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.generator = np.random.default_rng()
+        _local.pid = os.getpid()
+
+    return _local.generator
 
 
 class Noise:
-    def __init__(self, scale=DEFAULT_SCALE):
+    pixelwise = True
+
+    def __init__(self, scale=DEFAULT_SCALE, seed=None):
         self.scale = scale
+        self.dtype = DEFAULT_DTYPE
+        self.seed = seed
+        self.rng = np.random.Generator(np.random.Philox(key=seed)) if seed is not None else None
 
     def _apply(self, image):
         raise NotImplementedError
@@ -16,69 +36,299 @@ class Noise:
     def apply(self, image):
         noisy = self._apply(image)
 
-        noisy[noisy < self.scale[0]] = self.scale[0]
-        noisy[noisy > self.scale[1]] = self.scale[1]
+        np.clip(noisy, self.scale[0], self.scale[1], out=noisy)
+
+        return noisy
+
+    def _apply_batch(self, images):
+        if self.pixelwise:
+            return self._apply(images)
+
+        noisy = np.empty(images.shape, dtype=self.dtype)
+
+        for i in range(len(images)):
+            noisy[i] = self._apply(images[i])
+
+        return noisy
+
+    def apply_batch(self, images):
+        noisy = self._apply_batch(images)
+
+        np.clip(noisy, self.scale[0], self.scale[1], out=noisy)
 
         return noisy
 
     def set_scale(self, scale):
         self.scale = scale
 
+    def set_dtype(self, dtype):
+        self.dtype = dtype
+
+    def set_rng(self, rng):
+        self.rng = rng
+
+    def stream(self, epoch, index):
+        if self.seed is None:
+            raise ValueError('Can\'t create a stream without a seed')
+
+        noise = copy.copy(self)
+        noise.set_rng(np.random.Generator(np.random.Philox(key=self.seed, counter=[0, 0, index, epoch])))
+
+        return noise
+
+    def per_sample(self):
+        return self.seed is not None
+
+    def for_sample(self, epoch, index):
+        if self.seed is None:
+            return copy.copy(self)
+        else:
+            return self.stream(epoch, index)
+
+    def _generator(self):
+        if self.rng is not None:
+            return self.rng
+        else:
+            return _default_generator()
+
 
 class GaussianNoise(Noise):
-    def __init__(self, std=0.05, mean=0.0, scale=DEFAULT_SCALE):
-        Noise.__init__(self, scale)
+    def __init__(self, std=0.05, mean=0.0, scale=DEFAULT_SCALE, seed=None):
+        Noise.__init__(self, scale, seed)
 
         self.std = std
         self.mean = mean
 
     def _apply(self, image):
-        return image + np.random.normal(self.mean, self.std, image.shape) * self.scale[1]
+        noise = self._generator().standard_normal(image.shape, dtype=np.float32)
+        noise *= self.std * self.scale[1]
+        noise += self.mean * self.scale[1]
+
+        noisy = image.astype(self.dtype)
+        noisy += noise
+
+        return noisy
 
 
 class SaltAndPepperNoise(Noise):
-    def __init__(self, p=0.05, scale=DEFAULT_SCALE):
-        Noise.__init__(self, scale)
+    def __init__(self, p=0.05, scale=DEFAULT_SCALE, seed=None):
+        Noise.__init__(self, scale, seed)
 
         self.p = p
 
     def _apply(self, image):
-        noisy = np.copy(image)
+        noisy = np.array(image, dtype=self.dtype, order='C')
 
-        p = np.random.random(image.shape)
-
-        noisy[p < self.p / 2.] = self.scale[0]
-        noisy[p > (1 - self.p / 2.)] = self.scale[1]
+        self._corrupt(noisy, self._generator())
 
         return noisy
 
+    def _corrupt(self, noisy, rng):
+        if not noisy.flags.c_contiguous:
+            contiguous = np.ascontiguousarray(noisy)
+
+            self._corrupt(contiguous, rng)
+
+            noisy[...] = contiguous
+        elif np.ndim(self.p) == 0:
+            self._scatter(noisy.reshape(-1), self.p, rng)
+        else:
+            p = np.broadcast_to(self.p, noisy.shape[:1] + (1,) * (len(noisy.shape) - 1)).reshape(-1)
+
+            for i in range(len(noisy)):
+                self._scatter(noisy[i].reshape(-1), p[i], rng)
+
+    def _scatter(self, flat, p, rng):
+        if p > MAX_SPARSE_DENSITY:
+            draw = rng.random(flat.shape, dtype=np.float32)
+
+            flat[draw < p / 2.] = self.scale[0]
+            flat[draw > (1 - p / 2.)] = self.scale[1]
+
+            return
+
+        count = rng.binomial(flat.size, p)
+        indices = _distinct(rng.integers(flat.size, size=count))
+
+        while len(indices) < count:
+            indices = _distinct(np.concatenate([indices, rng.integers(flat.size, size=count - len(indices))]))
+
+        salt = rng.random(count) < 0.5
+
+        flat[indices[~salt]] = self.scale[0]
+        flat[indices[salt]] = self.scale[1]
+
+
+def _distinct(indices):
+    indices = np.sort(indices)
+    first = np.ones(len(indices), dtype=bool)
+    first[1:] = indices[1:] != indices[:-1]
+
+    return indices[first]
+
 
 class QuantizationNoise(Noise):
-    def __init__(self, q=0.01, scale=DEFAULT_SCALE):
-        Noise.__init__(self, scale)
+    def __init__(self, q=0.01, scale=DEFAULT_SCALE, seed=None):
+        Noise.__init__(self, scale, seed)
 
         self.q = q
 
     def _apply(self, image):
-        return image + self.q * np.random.random(image.shape) * self.scale[1]
+        noise = self._generator().random(image.shape, dtype=np.float32)
+        noise *= self.q * self.scale[1]
+
+        noisy = image.astype(self.dtype)
+        noisy += noise
+
+        return noisy
 
 
 class RandomNoise(Noise):
-    def __init__(self, type=None, range=(0.0, 0.5), scale=DEFAULT_SCALE):
-        Noise.__init__(self, scale)
+    def __init__(self, type=None, range=(0.0, 0.5), scale=DEFAULT_SCALE, seed=None):
+        Noise.__init__(self, scale, seed)
 
         self.type = type
         self.range = range
 
     def _apply(self, image):
+        rng = self._generator()
+
         if self.type:
             type = self.type
         else:
-            type = np.random.choice([GaussianNoise, SaltAndPepperNoise, QuantizationNoise])
+            types = [GaussianNoise, SaltAndPepperNoise, QuantizationNoise]
+            type = types[rng.integers(len(types))]
+
+        parameter = rng.random() * (self.range[1] - self.range[0]) + self.range[0]
 
-        parameter = np.random.random() * (self.range[1] - self.range[0]) + self.range[0]
+        noise = type(parameter, scale=self.scale)
+        noise.set_dtype(self.dtype)
+        noise.set_rng(rng)
 
-        return type(parameter, scale=self.scale)._apply(image)
+        return noise._apply(image)
+
+    def _apply_batch(self, images):
+        if self.type:
+            types = [self.type]
+        else:
+            types = [GaussianNoise, SaltAndPepperNoise, QuantizationNoise]
+
+        rng = self._generator()
+        choices = rng.integers(len(types), size=len(images))
+        parameters = rng.random(len(images)) * (self.range[1] - self.range[0]) + self.range[0]
+        parameters = parameters.reshape((-1,) + (1,) * (len(images.shape) - 1))
+
+        noisy = np.empty(images.shape, dtype=self.dtype)
+
+        for i, type in enumerate(types):
+            selected = np.nonzero(choices == i)[0]
+
+            if len(selected) == 0:
+                continue
+
+            if type.pixelwise:
+                noise = type(parameters[selected], scale=self.scale)
+                noise.set_dtype(self.dtype)
+                noise.set_rng(rng)
+
+                noisy[selected] = noise._apply(images[selected])
+            else:
+                for j in selected:
+                    noise = type(parameters[j].item(), scale=self.scale)
+                    noise.set_dtype(self.dtype)
+                    noise.set_rng(rng)
+
+                    noisy[j] = noise._apply(images[j])
+
+        return noisy
+
+
+class CompositeNoise(Noise):
+    def __init__(self, stages, scale=DEFAULT_SCALE, seed=None):
+        Noise.__init__(self, scale, seed)
+
+        self.stages = stages
+        self.pixelwise = all((stage[0] if isinstance(stage, tuple) else stage).pixelwise for stage in stages)
+
+    def _apply(self, image):
+        return self._apply_batch(image[np.newaxis])[0]
+
+    def _apply_batch(self, images):
+        rng = self._generator()
+        noisy = np.array(images, dtype=self.dtype, order='C')
+        fused = []
+
+        for stage in self.stages:
+            noises = self._configure(stage, images.shape, rng)
+
+            if len(noises) == 1 and _fusible(noises[0]):
+                fused.append(noises[0])
+
+                continue
+
+            self._apply_fused(noisy, fused, rng)
+
+            fused = []
+
+            if len(noises) == 1:
+                noisy = np.asarray(noises[0]._apply_batch(noisy), dtype=self.dtype)
+            else:
+                for i, noise in enumerate(noises):
+                    noisy[i] = noise._apply(noisy[i])
+
+        self._apply_fused(noisy, fused, rng)
+
+        return noisy
+
+    def _configure(self, stage, shape, rng):
+        if isinstance(stage, tuple):
+            type, range = stage
+
+            if not type.pixelwise and isinstance(range[0], int) and isinstance(range[1], int):
+                parameters = rng.integers(range[0], range[1] + 1, size=shape[0])
+            else:
+                parameters = rng.random(shape[0]) * (range[1] - range[0]) + range[0]
+
+            if type.pixelwise:
+                noises = [type(parameters.reshape((-1,) + (1,) * (len(shape) - 1)), scale=self.scale)]
+            else:
+                noises = [type(parameter, scale=self.scale) for parameter in parameters]
+        else:
+            noises = [copy.copy(stage)]
+
+        for noise in noises:
+            noise.set_scale(self.scale)
+            noise.set_dtype(self.dtype)
+            noise.set_rng(rng)
+
+        return noises
+
+    def _apply_fused(self, noisy, noises, rng):
+        if len(noises) == 0:
+            return
+
+        gaussian = len([noise for noise in noises if isinstance(noise, GaussianNoise)])
+        quantization = len([noise for noise in noises if isinstance(noise, QuantizationNoise)])
+        normals = iter(rng.standard_normal((gaussian,) + noisy.shape, dtype=np.float32))
+        uniforms = iter(rng.random((quantization,) + noisy.shape, dtype=np.float32))
+        high = self.scale[1]
+
+        for noise in noises:
+            if isinstance(noise, GaussianNoise):
+                draw = next(normals)
+                draw *= noise.std * high
+                draw += noise.mean * high
+                noisy += draw
+            elif isinstance(noise, QuantizationNoise):
+                draw = next(uniforms)
+                draw *= noise.q * high
+                noisy += draw
+            else:
+                noise._corrupt(noisy, rng)
+
+
+def _fusible(noise):
+    return type(noise) in (GaussianNoise, QuantizationNoise, SaltAndPepperNoise)
 
 
 class MotionBlur(Noise):
@@ -94,117 +344,230 @@ class MotionBlur(Noise):
     # Giacomo Boracchi and Alessandro Foi, Image Processing, IEEE Transactions on. vol. 20, no. 2, pp. 592-598,
     # Feb. 2011, doi: 10.1109/TIP.2010.2062196
 
-    def __init__(self, size=15, anxiety=0.005, exposure=10.0, lambd=0, gaussian=0.0, scale=DEFAULT_SCALE):
-        Noise.__init__(self, scale)
+    pixelwise = False
+
+    def __init__(self, size=15, anxiety=0.005, exposure=10.0, lambd=0, gaussian=0.0, scale=DEFAULT_SCALE, seed=None,
+                 bank=None, library=None, index=None, indices=None):
+        Noise.__init__(self, scale, seed)
 
         self.size = size
         self.anxiety = anxiety
         self.exposure = exposure
         self.lambd = lambd
         self.gaussian = gaussian
+        self.bank = bank
+        self.library = library
+        self.index = index
+        self.indices = indices
+        self.trajectories = None
+        self.psfs = None
         self.kernel = None
 
+        if (index is not None or indices is not None) and library is None:
+            raise ValueError('Can\'t index PSFs without a library')
+
+        if library is not None:
+            with open(library + '.json') as f:
+                parameters = json.load(f)
+
+            if (parameters['size'], parameters['anxiety'], parameters['exposure']) != (size, anxiety, exposure):
+                raise ValueError('Can\'t use a PSF library of size %d, anxiety %g and exposure %g with size %d, '
+                                 'anxiety %g and exposure %g' % (parameters['size'], parameters['anxiety'],
+                                                                 parameters['exposure'], size, anxiety, exposure))
+
+            self.psfs = np.load(library, mmap_mode='r')
+
+        if bank is not None:
+            with open(bank + '.json') as f:
+                parameters = json.load(f)
+
+            if (parameters['trajectory_size'], parameters['max_length'], parameters['anxiety']) != \
+                    (size, size, anxiety):
+                raise ValueError('Can\'t use a trajectory bank of size %d and anxiety %g with size %d and anxiety %g' %
+                                 (parameters['trajectory_size'], parameters['anxiety'], size, anxiety))
+
+            self.trajectories = np.load(bank, mmap_mode='r')
+
+    def indexed(self, index):
+        noise = copy.copy(self)
+        noise.index = index
+
+        return noise
+
+    def per_sample(self):
+        return Noise.per_sample(self) or self.indices is not None
+
+    def for_sample(self, epoch, index):
+        noise = Noise.for_sample(self, epoch, index)
+
+        if self.indices is not None:
+            noise.index = int(self.indices[index])
+
+        return noise
+
     def _apply(self, image):
-        trajectory = MotionBlur.create_trajectory(trajectory_size=self.size, anxiety=self.anxiety, max_length=self.size)
-        psf = MotionBlur.create_psf(trajectory, size=self.size, exposure=self.exposure)
-        blurred = MotionBlur.create_blurred_color(image, psf, self.lambd, self.gaussian)
+        if self.index is not None and np.ndim(self.index) != 0:
+            raise ValueError('Can\'t apply %d PSF indices to a single image' % np.size(self.index))
+
+        rng = self._generator()
+        psf = self._psfs(1, rng)[0]
+        blurred = MotionBlur.create_blurred_color(image.astype(self.dtype), psf, self.lambd, self.gaussian, rng=rng)
 
         self.kernel = psf
 
         return blurred
 
+    def _apply_batch(self, images):
+        rng = self._generator()
+        psfs = self._psfs(len(images), rng)
+        noisy = MotionBlur.create_blurred(images.astype(self.dtype), psfs, self.lambd, self.gaussian, rng=rng)
+
+        self.kernel = psfs[-1]
+
+        return np.asarray(noisy, dtype=self.dtype)
+
+    def _psfs(self, count, rng):
+        if self.library is None:
+            return MotionBlur.create_psf(self._trajectories(count, rng), size=self.size, exposure=self.exposure)
+
+        if self.index is not None:
+            if np.ndim(self.index) != 0 and np.size(self.index) != count:
+                raise ValueError('Can\'t apply %d PSF indices to %d images' % (np.size(self.index), count))
+
+            indices = np.broadcast_to(self.index, (count,))
+        else:
+            indices = rng.integers(len(self.psfs), size=count)
+
+        return np.asarray(self.psfs[indices], dtype=np.float64)
+
+    def _trajectories(self, count, rng):
+        if self.bank is None:
+            return MotionBlur.create_trajectories(count, trajectory_size=self.size, anxiety=self.anxiety,
+                                                  max_length=self.size, rng=rng)
+
+        return self.trajectories[np.sort(rng.integers(len(self.trajectories), size=count))]
+
+    @staticmethod
+    def create_trajectory(trajectory_size=64, anxiety=0.005, n_samples=2000, max_length=64, rng=np.random):
+        return MotionBlur.create_trajectories(1, trajectory_size, anxiety, n_samples, max_length, rng)[0]
+
     @staticmethod
-    def create_trajectory(trajectory_size=64, anxiety=0.005, n_samples=2000, max_length=64):
-        centripetal = 0.7 * np.random.random()
-        gaussian_term = 10 * np.random.random()
-        freq_big_shakes = 0.2 * np.random.random()
-        init_angle = 2 * np.pi * np.random.random()
+    def create_trajectories(count, trajectory_size=64, anxiety=0.005, n_samples=2000, max_length=64, rng=np.random):
+        centripetal = 0.7 * rng.random(count)
+        gaussian_term = 10 * rng.random(count)
+        freq_big_shakes = 0.2 * rng.random(count)
+        init_angle = 2 * np.pi * rng.random(count)
         v0 = np.cos(init_angle) + 1j * np.sin(init_angle)
+        step = max_length / float(n_samples - 1)
 
         if anxiety > 0:
             v = v0 * anxiety
         else:
-            v = v0 * max_length / float(n_samples - 1)
+            v = v0 * step
 
-        x = np.zeros(n_samples, dtype=np.complex)
+        shakes = rng.random((n_samples - 1, count)) < freq_big_shakes * anxiety
+        angles = np.exp(1j * (np.pi + rng.random((n_samples - 1, count)) - 0.5))
+        boost = 1 + 2 * np.where(shakes, angles, 0)
+        gaussian = anxiety * step * gaussian_term * (rng.normal(size=(n_samples - 1, count)) +
+                                                     1j * rng.normal(size=(n_samples - 1, count)))
+        pull = anxiety * step * centripetal
 
-        for t in range(n_samples - 1):
-            if np.random.random() < freq_big_shakes * anxiety:
-                next_direction = 2 * v * np.exp(1j * (np.pi + np.random.random() - 0.5))
-            else:
-                next_direction = 0
+        x = np.zeros((n_samples, count), dtype=np.complex128)
 
-            dv = next_direction + anxiety * (gaussian_term * (np.random.normal() + 1j * np.random.normal()) -
-                                             centripetal * x[t]) * (max_length / float(n_samples - 1))
-            v += dv
-            v = (v / np.abs(v)) * max_length / (n_samples - 1)
+        for t in range(n_samples - 1):
+            v = v * boost[t] + gaussian[t] - pull * x[t]
+            v = (v / np.abs(v)) * step
             x[t + 1] = x[t] + v
 
-        x = x - 1j * np.min(np.imag(x)) - np.min(np.real(x))
-        x = x - 1j * (np.imag(x[0]) % 1) - (np.real(x[0]) % 1) + 1 + 1j
-        x = x + 1j * np.ceil((trajectory_size - np.max(np.imag(x))) / 2.) + \
-            np.ceil((trajectory_size - np.max(np.real(x))) / 2.)
+        x = x.T
+        x = x - 1j * np.min(np.imag(x), axis=1, keepdims=True) - np.min(np.real(x), axis=1, keepdims=True)
+        x = x - 1j * (np.imag(x[:, :1]) % 1) - (np.real(x[:, :1]) % 1) + 1 + 1j
+        x = x + 1j * np.ceil((trajectory_size - np.max(np.imag(x), axis=1, keepdims=True)) / 2.) + \
+            np.ceil((trajectory_size - np.max(np.real(x), axis=1, keepdims=True)) / 2.)
 
         return x
 
+    @staticmethod
+    def create_trajectory_bank(path, count, trajectory_size=64, anxiety=0.005, n_samples=2000, max_length=64,
+                               rng=np.random, chunk=1000):
+        bank = np.lib.format.open_memmap(path, mode='w+', dtype=np.complex64, shape=(count, n_samples))
+
+        for i in range(0, count, chunk):
+            bank[i:(i + chunk)] = MotionBlur.create_trajectories(min(chunk, count - i), trajectory_size, anxiety,
+                                                                 n_samples, max_length, rng)
+
+        bank.flush()
+
+        with open(path + '.json', 'w') as f:
+            json.dump({'trajectory_size': trajectory_size, 'anxiety': anxiety, 'n_samples': n_samples,
+                       'max_length': max_length}, f)
+
+    @staticmethod
+    def create_psf_library(path, count, size=15, anxiety=0.005, exposure=10.0, rng=np.random, chunk=1000):
+        library = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(count, size, size))
+
+        for i in range(0, count, chunk):
+            trajectories = MotionBlur.create_trajectories(min(chunk, count - i), trajectory_size=size, anxiety=anxiety,
+                                                          max_length=size, rng=rng)
+            library[i:(i + chunk)] = MotionBlur.create_psf(trajectories, size=size, exposure=exposure)
+
+        library.flush()
+
+        with open(path + '.json', 'w') as f:
+            json.dump({'size': size, 'anxiety': anxiety, 'exposure': exposure}, f)
+
     @staticmethod
     def create_psf(trajectory, size=15, exposure=10.0):
-        n_samples = len(trajectory)
-        x = trajectory
-        psf = np.zeros((size, size))
-
-        x = x - np.mean(x) + (size + 1j * size) / 2.
-
-        triangle_fun = lambda d: np.max((0, 1 - np.abs(d)))
-        triangle_fun_prod = lambda d1, d2: triangle_fun(d1) * triangle_fun(d2)
-
-        for t in range(1, len(x) + 1):
-            if exposure * n_samples >= t > 1:
-                t_proportion = 1
-            elif exposure * n_samples + 1 >= t > 1:
-                t_proportion = exposure * n_samples - t + 1
-            elif exposure * n_samples >= t > 0:
-                t_proportion = t
-            elif exposure * n_samples + 1 >= t > 0:
-                t_proportion = exposure * n_samples
-            else:
-                t_proportion = 0
+        x = np.asarray(trajectory, dtype=np.complex128)
+        batch = x.reshape((-1, x.shape[-1]))
+        n_samples = batch.shape[1]
+
+        # Row-wise means and sums keep the summation order, and so the result, identical to a single trajectory.
+        batch = batch - np.array([[np.mean(row)] for row in batch]) + (size + 1j * size) / 2.
+
+        t = np.arange(1, n_samples + 1)
+        limit = exposure * n_samples
+        t_proportion = np.select([(limit >= t) & (t > 1), (limit + 1 >= t) & (t > 1), (limit >= t) & (t > 0),
+                                  (limit + 1 >= t) & (t > 0)], [1, limit - t + 1, t, limit], 0)
+
+        real, imag = np.real(batch), np.imag(batch)
+        m2 = np.clip(np.floor(real), 1, size - 1).astype(np.int64) - 1
+        m1 = np.clip(np.floor(imag), 1, size - 1).astype(np.int64) - 1
+
+        triangle_fun = lambda d: np.maximum(0, 1 - np.abs(d))
+
+        rows = np.stack([m1, m1, m1 + 1, m1 + 1], axis=-1)
+        columns = np.stack([m2, m2 + 1, m2, m2 + 1], axis=-1)
+        weights = t_proportion[:, np.newaxis] * (triangle_fun(real[..., np.newaxis] - columns) *
+                                                 triangle_fun(imag[..., np.newaxis] - rows))
 
-            m2 = int(np.min((size - 1, np.max((1, np.floor(np.real(x[t - 1])))))) - 1)
-            M2 = m2 + 1
-            m1 = int(np.min((size - 1, np.max((1, np.floor(np.imag(x[t - 1])))))) - 1)
-            M1 = m1 + 1
+        offsets = np.arange(len(batch)).reshape((-1, 1, 1)) * size * size
+        psf = np.bincount((offsets + rows * size + columns).ravel(), weights=weights.ravel(),
+                          minlength=len(batch) * size * size).reshape((-1, size, size))
 
-            psf[m1][m2] += t_proportion * triangle_fun_prod(np.real(x[t - 1]) - m2, np.imag(x[t - 1]) - m1)
-            psf[m1][M2] += t_proportion * triangle_fun_prod(np.real(x[t - 1]) - M2, np.imag(x[t - 1]) - m1)
-            psf[M1][m2] += t_proportion * triangle_fun_prod(np.real(x[t - 1]) - m2, np.imag(x[t - 1]) - M1)
-            psf[M1][M2] += t_proportion * triangle_fun_prod(np.real(x[t - 1]) - M2, np.imag(x[t - 1]) - M1)
+        for i in range(len(psf)):
+            psf[i] /= np.sum(psf[i])
 
-        return psf / np.sum(psf)
+        return psf.reshape(x.shape[:-1] + (size, size))
 
     @staticmethod
-    def create_blurred(y, psf, lambd, sigma):
-        blurred = ndimage.convolve(y, psf)
+    def create_blurred(y, psf, lambd, sigma, rng=np.random):
+        blurred = blur.convolve(y, psf)
 
         if lambd > 0:
             blurred = blurred * lambd
-            blurred = np.random.poisson(blurred * (blurred > 0))
+            blurred = rng.poisson(blurred * (blurred > 0))
             blurred = blurred / float(lambd)
 
         if sigma > 0:
-            blurred = blurred + sigma * np.random.normal(size=blurred.shape)
+            blurred = blurred + sigma * rng.normal(size=blurred.shape)
 
         return blurred
 
     @staticmethod
-    def create_blurred_color(y, psf, lambd, sigma):
+    def create_blurred_color(y, psf, lambd, sigma, rng=np.random):
         assert len(y.shape) in [2, 3]
-        if len(y.shape) == 2:
-            return MotionBlur.create_blurred(y, psf, lambd, sigma)
-        elif len(y.shape) == 3:
-            result = np.zeros(y.shape)
 
-            for i in range(y.shape[2]):
-                result[:, :, i] = MotionBlur.create_blurred(y[:, :, i], psf, lambd, sigma)
+        blurred = MotionBlur.create_blurred(y, psf, lambd, sigma, rng)
 
-            return result
+        return np.asarray(blurred, dtype=np.result_type(y.dtype, np.float32))
@@ -0,0 +1,142 @@
+import os
+import json
+import argparse
+import numpy as np
+
+from multiprocessing.pool import ThreadPool
+from containers import Image, ImageCollection
+from resize import resize
+
+
+def write_records(dataset, path, shape, shard_size=2 ** 30, chunk=256, workers=4):
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    chunks = [np.arange(i, min(i + chunk, dataset.size)) for i in range(0, dataset.size, chunk)]
+    pool = ThreadPool(workers)
+    counts = []
+    record_shape = None
+    f = None
+
+    try:
+        for pixels in pool.imap(lambda indices: _pixels(dataset.images, indices, shape), chunks):
+            if record_shape is None:
+                record_shape = pixels.shape[1:]
+                per_shard = max(1, shard_size // pixels[0].nbytes)
+
+            for record in pixels:
+                if f is None or counts[-1] >= per_shard:
+                    if f is not None:
+                        f.close()
+
+                    f = open(os.path.join(path, 'shard_%05d.bin' % len(counts)), 'wb')
+                    counts.append(0)
+
+                f.write(record.tobytes())
+                counts[-1] += 1
+    finally:
+        pool.terminate()
+
+        if f is not None:
+            f.close()
+
+    metadata = {'shape': list(record_shape), 'counts': counts}
+
+    if dataset.targets is not None:
+        if dataset.targets.dtype == np.dtype('O'):
+            labels = np.array([np.argmax(target.get()) for target in dataset.targets])
+        else:
+            labels = dataset.targets
+
+        np.save(os.path.join(path, 'labels.npy'), labels.astype(np.int32))
+
+        metadata['classes'] = getattr(dataset, 'classes', None) or int(np.max(labels)) + 1
+
+    with open(os.path.join(path, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+
+
+def _pixels(images, indices, shape):
+    if isinstance(images, ImageCollection):
+        return ImageCollection(images.images, shape=shape, normalize=False, indices=images.indices[indices],
+                               transpose=images.transpose).get()
+
+    result = []
+
+    for image in images[indices]:
+        if image.path is not None:
+            pixels = Image(path=image.path, shape=shape, keep_in_memory=False, normalize=False, draft=image.draft,
+                           cache=image.cache).get()
+        else:
+            pixels = image.get()
+
+            if image.normalize:
+                pixels = np.clip(np.rint(pixels * 255), 0, 255).astype(np.uint8)
+
+            pixels = resize(pixels, shape)
+
+        result.append(pixels)
+
+    return np.array(result, dtype=np.uint8)
+
+
+class RecordArray:
+    def __init__(self, path):
+        with open(os.path.join(path, 'metadata.json')) as f:
+            metadata = json.load(f)
+
+        self.path = path
+        self.shape = tuple(metadata['shape'])
+        self.classes = metadata.get('classes')
+        self.offsets = np.cumsum([0] + metadata['counts'])
+        self.shards = [np.memmap(os.path.join(path, 'shard_%05d.bin' % i), dtype=np.uint8, mode='r',
+                                 shape=(count,) + self.shape) for i, count in enumerate(metadata['counts'])]
+
+        if os.path.exists(os.path.join(path, 'labels.npy')):
+            self.labels = np.load(os.path.join(path, 'labels.npy'))
+        else:
+            self.labels = None
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            shard = np.searchsorted(self.offsets, index, side='right') - 1
+
+            return self.shards[shard][index - self.offsets[shard]]
+
+        index = np.arange(len(self))[index] if isinstance(index, slice) else np.asarray(index)
+        result = np.empty((len(index),) + self.shape, dtype=np.uint8)
+        shards = np.searchsorted(self.offsets, index, side='right') - 1
+
+        for shard in np.unique(shards):
+            positions = np.nonzero(shards == shard)[0]
+            local = index[positions] - self.offsets[shard]
+            order = np.argsort(local)
+
+            result[positions[order]] = self.shards[shard][local[order]]
+
+        return result
+
+
+if __name__ == '__main__':
+    import loaders
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('loader')
+    parser.add_argument('path')
+    parser.add_argument('-shape', type=int, nargs=2, required=True)
+    parser.add_argument('-names', nargs='+', default=['train', 'val'])
+    parser.add_argument('-shard_size', type=int, default=2 ** 30)
+    parser.add_argument('-workers', type=int, default=4)
+
+    args = parser.parse_args()
+    datasets = getattr(loaders, args.loader)()
+
+    if isinstance(datasets, tuple):
+        for name, dataset in zip(args.names, datasets):
+            write_records(dataset, os.path.join(args.path, name), args.shape, shard_size=args.shard_size,
+                          workers=args.workers)
+    else:
+        write_records(datasets, args.path, args.shape, shard_size=args.shard_size, workers=args.workers)
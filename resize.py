@@ -0,0 +1,67 @@
+import numpy as np
+
+
+MAX_CACHED_WEIGHTS = 256
+
+_weights = {}
+
+
+def weights(source, target):
+    key = (source, target)
+
+    if key not in _weights:
+        if len(_weights) >= MAX_CACHED_WEIGHTS:
+            _weights.clear()
+
+        scale = source / float(target)
+        support = max(scale, 1.0)
+        centers = (np.arange(target) + 0.5) * scale
+        distances = (np.arange(source)[np.newaxis, :] + 0.5 - centers[:, np.newaxis]) / support
+
+        matrix = np.maximum(0.0, 1.0 - np.abs(distances)).astype(np.float32)
+        matrix /= np.sum(matrix, axis=1, keepdims=True)
+
+        _weights[key] = matrix
+
+    return _weights[key]
+
+
+def resize(image, shape, dtype=None):
+    return resize_batch(image[np.newaxis], shape, dtype=dtype)[0]
+
+
+def resize_batch(images, shape, dtype=None, chunk=None):
+    images = np.asarray(images)
+    height, width = int(shape[0]), int(shape[1])
+
+    if dtype is None:
+        dtype = images.dtype
+
+    if chunk is not None and len(images) > chunk:
+        result = np.empty((len(images), height, width) + images.shape[3:], dtype=dtype)
+
+        for i in range(0, len(images), chunk):
+            result[i:(i + chunk)] = resize_batch(images[i:(i + chunk)], shape, dtype=dtype)
+
+        return result
+
+    n, h, w = images.shape[0:3]
+    rest = images.shape[3:]
+    columns = int(np.prod(rest))
+
+    result = images.astype(np.float32)
+
+    if h != height:
+        result = np.matmul(weights(h, height), result.reshape(n, h, w * columns))
+        result = result.reshape((n, height, w) + rest)
+
+    if w != width:
+        result = result.reshape(n * height, w, columns)
+        result = np.matmul(weights(w, width), result)
+        result = result.reshape((n, height, width) + rest)
+
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        info = np.iinfo(dtype)
+        result = np.clip(np.rint(result), info.min, info.max)
+
+    return result.astype(dtype, copy=False)
@@ -153,11 +153,11 @@ class Trainer:
 
     def _score(self, dataset):
         scores = []
-        initial_epoch = dataset.epochs_completed
+        sizes = []
 
-        while initial_epoch == dataset.epochs_completed:
-            x, y_ = dataset.batch()
+        for x, y_ in dataset.iterate_once():
             scores.append(self.score.eval(feed_dict={self.network.x: x, self.network.y_: y_,
                                                      self.network.keep_prob: 1.0}))
+            sizes.append(len(x))
 
-        return np.mean(scores)
+        return np.average(scores, weights=sizes)